@@ -1,7 +1,10 @@
 import logging
+import os
 import regex
 import sys
 from collections import defaultdict, Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 
 """
 A Python 3 refactoring of Vincent Van Asch's Python 2 code at
@@ -19,32 +22,85 @@ Biocomputing, 2003, pp 451-462.
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 log = logging.getLogger(__name__)
 
+# Quotes just inside brackets, e.g. ("PoCA 2002")
+_RE_BRACKET_QUOTES = regex.compile(r'([(])[\'"\p{Pi}]|[\'"\p{Pf}]([);:])')
 
-class Candidate(str):
-    def __init__(self, value):
-        super().__init__()
-        self.start = 0
-        self.stop = 0
 
-    def set_position(self, start, stop):
+class Candidate:
+    """
+    A span of text within a sentence
+    """
+    __slots__ = ('text', 'start', 'stop')
+
+    def __init__(self, text, start=0, stop=0):
+        self.text = text
         self.start = start
         self.stop = stop
 
+    def __str__(self):
+        return self.text
+
+    # Compare and hash like the text, as when Candidate was a str subclass
+    def __eq__(self, other):
+        if isinstance(other, Candidate):
+            other = other.text
+        if isinstance(other, str):
+            return self.text == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.text)
+
+    def __repr__(self):
+        return 'Candidate({!r}, {}, {})'.format(self.text, self.start, self.stop)
+
+    def __len__(self):
+        return len(self.text)
+
 
 def yield_lines_from_file(file_path):
-    with open(file_path, 'rb') as f:
+    # 1 MiB buffer to cut down on read calls for large corpora
+    with open(file_path, 'rb', buffering=1 << 20) as f:
         for line in f:
             try:
                 line = line.decode('utf-8')
             except UnicodeDecodeError:
-                line = line.decode('latin-1').encode('utf-8').decode('utf-8')
-            line = line.strip()
-            yield line
+                line = line.decode('latin-1')
+            yield line.strip()
 
 
 def yield_lines_from_doc(doc_text):
-    for line in doc_text.split("\n"):
-        yield line.strip()
+    # splitlines also breaks on '\r', form feeds and Unicode line separators, not only '\n'
+    return (line.strip() for line in doc_text.splitlines())
+
+
+def _find_closing(sentence, start):
+    """
+    :param sentence: line read from input file
+    :param start: index to start searching from
+    :return: index of the first ')', ';' or ':' at or after start, or -1
+    """
+    close_index = sentence.find(')', start)
+    end = close_index if close_index != -1 else len(sentence)
+    for char in ';:':
+        index = sentence.find(char, start, end)
+        if index != -1:
+            close_index = end = index
+    return close_index
+
+
+def _strip_span(sentence, start, stop):
+    """
+    :param sentence: line read from input file
+    :param start: start index of a span within sentence
+    :param stop: stop index of the span
+    :return: (start, stop) moved inwards past any surrounding whitespace
+    """
+    while start < stop and sentence[start].isspace():
+        start += 1
+    while stop > start and sentence[stop - 1].isspace():
+        stop -= 1
+    return start, stop
 
 
 def best_candidates(sentence):
@@ -53,60 +109,62 @@ def best_candidates(sentence):
     :return: a Candidate iterator
     """
 
-    if '(' in sentence:
-        # Check some things first
-        if sentence.count('(') != sentence.count(')'):
-            raise ValueError("Unbalanced parentheses: {}".format(sentence))
+    first_open = sentence.find('(')
+    if first_open == -1:
+        return
 
-        if sentence.find('(') > sentence.find(')'):
-            raise ValueError("First parentheses is right: {}".format(sentence))
+    # Check some things first
+    first_close = sentence.find(')')
+    if first_close == -1:
+        raise ValueError("Unbalanced parentheses: {}".format(sentence))
 
-        close_index = -1
-        while 1:
-            # Look for open parenthesis. Need leading whitespace to avoid matching mathematical and chemical formulae
-            open_index = sentence.find(' (', close_index + 1)
-
-            if open_index == -1: break
+    # A single pair is balanced, only count when there are more
+    if sentence.find('(', first_open + 1) != -1 or sentence.find(')', first_close + 1) != -1:
+        if sentence.count('(') != sentence.count(')'):
+            raise ValueError("Unbalanced parentheses: {}".format(sentence))
 
-            # Advance beyond whitespace
-            open_index += 1
+    if first_open > first_close:
+        raise ValueError("First parentheses is right: {}".format(sentence))
 
-            # Look for closing parentheses
+    close_index = -1
+    while 1:
+        # Look for open parenthesis. Need leading whitespace to avoid matching mathematical and chemical formulae
+        open_index = sentence.find(' (', close_index + 1)
+
+        if open_index == -1: break
+
+        # Advance beyond whitespace
+        open_index += 1
+
+        # Look for closing parentheses
+        close_index = open_index + 1
+        open_count = 1
+        skip = False
+        while open_count:
+            next_close = _find_closing(sentence, close_index)
+            if next_close == -1:
+                # We found an opening bracket but no associated closing bracket
+                # Skip the opening bracket
+                skip = True
+                break
+            # Nested brackets before the next closing one keep the candidate open
+            open_count += sentence.count('(', close_index, next_close) - 1
+            close_index = next_close + 1
+
+        if skip:
             close_index = open_index + 1
-            open_count = 1
-            skip = False
-            while open_count:
-                try:
-                    char = sentence[close_index]
-                except IndexError:
-                    # We found an opening bracket but no associated closing bracket
-                    # Skip the opening bracket
-                    skip = True
-                    break
-                if char == '(':
-                    open_count += 1
-                elif char in [')', ';', ':']:
-                    open_count -= 1
-                close_index += 1
-
-            if skip:
-                close_index = open_index + 1
-                continue
+            continue
 
-            # Output if conditions are met
-            start = open_index + 1
-            stop = close_index - 1
-            candidate = sentence[start:stop]
+        # Output if conditions are met
+        start = open_index + 1
+        stop = close_index - 1
 
-            # Take into account whitespace that should be removed
-            start = start + len(candidate) - len(candidate.lstrip())
-            stop = stop - len(candidate) + len(candidate.rstrip())
-            candidate = sentence[start:stop]
+        # Take into account whitespace that should be removed
+        start, stop = _strip_span(sentence, start, stop)
+        candidate = sentence[start:stop]
 
-            if conditions(candidate):
-                new_candidate = Candidate(candidate)
-                new_candidate.set_position(start, stop)
-                yield new_candidate
+        if conditions(candidate):
+            yield Candidate(candidate, start, stop)
 
 
 def conditions(candidate):
@@ -115,32 +173,30 @@ def conditions(candidate):
 
     2 <= len(str) <= 10
     len(tokens) <= 2
-    re.search(r'\p{L}', str)
+    str contains a letter
     str[0].isalnum()
 
-    and extra:
-    if it matches (\p{L}\.?\s?){2,}
-    it is a good candidate.
-
     :param candidate: candidate abbreviation
     :return: True if this is a good candidate
     """
-    viable = True
-    if regex.match(r'(\p{L}\.?\s?){2,}', candidate.lstrip()):
-        viable = True
     if len(candidate) < 2 or len(candidate) > 10:
-        viable = False
+        return False
     if len(candidate.split()) > 2:
-        viable = False
-    if not regex.search(r'\p{L}', candidate):
-        viable = False
+        return False
     if not candidate[0].isalnum():
-        viable = False
+        return False
+    if candidate.isascii():
+        # Every ASCII letter has case, so there is a letter iff the case can change
+        if candidate.lower() == candidate.upper():
+            return False
+    # str.isalpha covers the same Unicode categories as \p{L}
+    elif not any(char.isalpha() for char in candidate):
+        return False
 
-    return viable
+    return True
 
 
-def get_definition(candidate, sentence):
+def get_definition(candidate, sentence, sentence_lower=None):
     """
     Takes a candidate and a sentence and returns the definition candidate.
 
@@ -149,58 +205,63 @@ def get_definition(candidate, sentence):
 
     :param candidate: candidate abbreviation
     :param sentence: current sentence (single line from input file)
-    :return: candidate definition for this abbreviation
+    :param sentence_lower: the sentence lowercased by _lower_chars, shared between candidates
+    :return: candidate definition for this abbreviation, or None if there is none
     """
+    if sentence_lower is None:
+        sentence_lower = _lower_chars(sentence)
+
     # Take the tokens in front of the candidate
-    tokens = regex.split(r'[\s\-]+', sentence[:candidate.start - 2].lower())
+    prefix = sentence_lower[:candidate.start - 2]
+    if not isinstance(prefix, str):
+        prefix = ''.join(prefix)
+    tokens = regex.split(r'[\s\-]+', prefix)
     # the char that we are looking for
-    key = candidate[0].lower()
+    key = candidate.text[0].lower()
 
-    # Count the number of tokens that start with the same character as the candidate
-    first_chars = [t[0] for t in filter(None, tokens)]
+    # Positions of the tokens that start with the same character as the candidate
+    key_positions = [i for i, t in enumerate(filter(None, tokens)) if t[0] == key]
 
-    definition_freq = first_chars.count(key)
-    candidate_freq = candidate.lower().count(key)
+    definition_freq = len(key_positions)
+    candidate_freq = candidate.text.lower().count(key)
 
     # Look for the list of tokens in front of candidate that
     # have a sufficient number of tokens starting with key
-    if candidate_freq <= definition_freq:
-        # we should at least have a good number of starts
-        count = 0
-        start = 0
-        start_index = len(first_chars) - 1
-        while count < candidate_freq:
-            if abs(start) > len(first_chars):
-                raise ValueError("candidate {} not found".format(candidate))
-            start -= 1
-            # Look up key in the definition
-            try:
-                start_index = first_chars.index(key, len(first_chars) + start)
-            except ValueError:
-                pass
+    if candidate_freq > definition_freq:
+        # There are less keys in the tokens in front of candidate than there are in the candidate
+        return None
 
-            # Count the number of keys in definition
-            count = first_chars[start_index:].count(key)
+    start_index = key_positions[-candidate_freq]
 
-        # We found enough keys in the definition so return the definition as a definition candidate
-        start = len(' '.join(tokens[:start_index]))
-        stop = candidate.start - 1
-        candidate = sentence[start:stop]
+    # We found enough keys in the definition so return the definition as a definition candidate
+    start = len(' '.join(tokens[:start_index]))
+    stop = candidate.start - 1
 
-        # Remove whitespace
-        start = start + len(candidate) - len(candidate.lstrip())
-        stop = stop - len(candidate) + len(candidate.rstrip())
-        candidate = sentence[start:stop]
+    # Remove whitespace
+    start, stop = _strip_span(sentence, start, stop)
+    candidate = sentence[start:stop]
 
-        new_candidate = Candidate(candidate)
-        new_candidate.set_position(start, stop)
-        return new_candidate
+    return Candidate(candidate, start, stop)
 
-    else:
-        raise ValueError('There are less keys in the tokens in front of candidate than there are in the candidate')
 
+def _lower_chars(text):
+    """
+    Lowercase text once so that it can be indexed per character.
 
-def select_definition(definition, abbrev):
+    Falls back to lowercasing each character when lowercasing the whole text
+    would not match that: str.lower() can change the length of the text
+    (e.g. 'İ') and lowercases 'Σ' depending on its context.
+    """
+    if text.isascii():
+        return text.lower()
+    if 'Σ' not in text:
+        lowered = text.lower()
+        if len(lowered) == len(text):
+            return lowered
+    return [char.lower() for char in text]
+
+
+def select_definition(definition, abbrev, sentence_lower=None):
     """
     Takes a definition candidate and an abbreviation candidate
     and returns True if the chars in the abbreviation occur in the definition
@@ -209,39 +270,71 @@ def select_definition(definition, abbrev):
     A simple algorithm for identifying abbreviation definitions in biomedical texts, Schwartz & Hearst
     :param definition: candidate definition
     :param abbrev: candidate abbreviation
-    :return:
+    :param sentence_lower: the sentence lowercased by _lower_chars, shared between candidates
+    :return: the definition trimmed to the abbreviation, or None if it does not match
     """
+    return _match_definition(definition, abbrev, sentence_lower)[0]
 
-    if len(definition) < len(abbrev):
-        raise ValueError('Abbreviation is longer than definition')
 
-    if abbrev in definition.split():
-        raise ValueError('Abbreviation is full word of definition')
+def _match_definition(definition, abbrev, sentence_lower=None):
+    """
+    Does the work of select_definition, also saying why a definition was rejected
+
+    :param definition: candidate definition
+    :param abbrev: candidate abbreviation
+    :param sentence_lower: the sentence lowercased by _lower_chars, shared between candidates
+    :return: (the definition trimmed to the abbreviation or None, reason for rejecting it or None)
+    """
+
+    definition_text = definition.text
+    abbrev_text = abbrev.text
+
+    if len(definition_text) < len(abbrev_text):
+        return None, 'abbreviation is longer than definition'
+
+    if abbrev_text in definition_text.split():
+        return None, 'abbreviation is full word of definition'
+
+    definition_len = len(definition_text)
+    abbrev_len = len(abbrev_text)
+    if sentence_lower is None:
+        definition_lower = _lower_chars(definition_text)
+    else:
+        definition_lower = sentence_lower[definition.start:definition.stop]
+    abbrev_lower = _lower_chars(abbrev_text)
+    # Mismatches can be skipped with rfind when both sides hold single characters
+    can_skip = isinstance(definition_lower, str) and isinstance(abbrev_lower, str)
 
     s_index = -1
     l_index = -1
 
     while 1:
-        try:
-            long_char = definition[l_index].lower()
-        except IndexError:
-            raise
+        # Ran past the start of the definition without finding the abbreviation
+        if l_index < -definition_len or s_index < -abbrev_len:
+            return None, 'abbreviation not found in definition'
 
-        short_char = abbrev[s_index].lower()
+        long_char = definition_lower[l_index]
+        short_char = abbrev_lower[s_index]
+
+        if can_skip and short_char != long_char and short_char.isalnum():
+            # Jump straight to the previous occurrence of short_char in the definition
+            found = definition_lower.rfind(short_char, 0, definition_len + l_index)
+            if found == -1:
+                return None, 'abbreviation not found in definition'
+            l_index = found - definition_len
+            long_char = short_char
 
         if not short_char.isalnum():
             s_index -= 1
 
-        if s_index == -1 * len(abbrev):
+        if s_index == -abbrev_len:
             if short_char == long_char:
-                if l_index == -1 * len(definition) or not definition[l_index - 1].isalnum():
+                if l_index == -definition_len or not definition_text[l_index - 1].isalnum():
                     break
                 else:
                     l_index -= 1
             else:
                 l_index -= 1
-                if l_index == -1 * (len(definition) + 1):
-                    raise ValueError("definition {} was not found in {}".format(abbrev, definition))
 
         else:
             if short_char == long_char:
@@ -250,27 +343,102 @@ def select_definition(definition, abbrev):
             else:
                 l_index -= 1
 
-    new_candidate = Candidate(definition[l_index:len(definition)])
-    new_candidate.set_position(definition.start, definition.stop)
-    definition = new_candidate
+    definition_text = definition_text[l_index:definition_len]
+
+    # Do not return definitions that contain unbalanced parentheses.
+    # Checked on the matched text only: the unmatched prefix may hold an unclosed bracket
+    if definition_text.count('(') != definition_text.count(')'):
+        return None, 'unbalanced parentheses in definition'
+
+    tokens = len(definition_text.split())
+
+    if tokens > min([abbrev_len + 5, abbrev_len * 2]):
+        return None, 'did not meet min(|A|+5, |A|*2) constraint'
+
+    return Candidate(definition_text, definition.start, definition.stop), None
+
+
+def _extract_from_sentence(indexed_sentence):
+    """
+    Runs the candidate, definition and selection steps on a single sentence
+
+    :param indexed_sentence: (line number, line read from input)
+    :return: list of (abbreviation, definition) pairs and the number of omitted candidates
+    """
+    i, sentence = indexed_sentence
+    sentence_pairs = []
+    omit = 0
+
+    # Only sentences with an opening bracket can contain a candidate
+    if '(' not in sentence:
+        return sentence_pairs, omit
+
+    # Remove any quotes around potential candidate terms
+    clean_sentence = _RE_BRACKET_QUOTES.sub(r'\1\2', sentence)
+    sentence_lower = None
+    try:
+        for candidate in best_candidates(clean_sentence):
+            if sentence_lower is None:
+                sentence_lower = _lower_chars(clean_sentence)
+
+            definition = get_definition(candidate, clean_sentence, sentence_lower)
+            if definition is None:
+                log.debug("%s Omitting candidate %s. Reason: not enough tokens start with its first character", i, candidate)
+                omit += 1
+                continue
+
+            selected, reason = _match_definition(definition, candidate, sentence_lower)
+            if selected is None:
+                log.debug("%s Omitting definition %s for candidate %s. Reason: %s", i, definition, candidate, reason)
+                omit += 1
+                continue
+
+            sentence_pairs.append((candidate.text, selected.text))
+    except (ValueError, IndexError) as e:
+        log.debug("%s Error processing sentence %s: %s", i, sentence, e.args[0])
 
-    tokens = len(definition.split())
-    length = len(abbrev)
+    return sentence_pairs, omit
 
-    if tokens > min([length + 5, length * 2]):
-        raise ValueError("did not meet min(|A|+5, |A|*2) constraint")
 
-    # Do not return definitions that contain unbalanced parentheses
-    if definition.count('(') != definition.count(')'):
-        raise ValueError("Unbalanced parentheses not allowed in a definition")
+def _map_in_processes(indexed_sentences, processes, chunksize=512):
+    """
+    Runs _extract_from_sentence over a process pool, in order.
+
+    Sentences are read and submitted in bounded batches so that a large
+    input is streamed rather than queued up in the pool all at once.
 
-    return definition
+    :param indexed_sentences: iterator of (line number, line read from input)
+    :param processes: number of worker processes, None for one per CPU
+    :param chunksize: number of sentences sent to a worker at a time
+    :return: iterator of the _extract_from_sentence results, in input order
+    """
+    workers = processes or os.cpu_count() or 1
+    batch_size = workers * chunksize * 4
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            batch = list(islice(indexed_sentences, batch_size))
+            if not batch:
+                break
+            # Sentences are independent; map() keeps them in order so later definitions still win
+            yield from executor.map(_extract_from_sentence, batch, chunksize=chunksize)
 
 
 def extract_abbreviation_definition_pairs(file_path=None,
                                           doc_text=None,
                                           most_common_definition=False,
-                                          first_definition=False):
+                                          first_definition=False,
+                                          processes=1):
+    """
+    :param file_path: path to a text file to read sentences from, one per line
+    :param doc_text: text to read sentences from, one per line
+    :param most_common_definition: return the most common definition for each abbreviation
+    :param first_definition: return the first definition for each abbreviation
+    :param processes: number of worker processes to spread the sentences over, None for one per CPU
+    :return: dict of abbreviation: definition pairs
+    """
+    if processes is not None and processes < 1:
+        raise ValueError("processes must be at least 1 or None, got {}".format(processes))
+
     abbrev_map = dict()
     list_abbrev_map = defaultdict(list)
     counter_abbrev_map = dict()
@@ -287,33 +455,25 @@ def extract_abbreviation_definition_pairs(file_path=None,
     if most_common_definition or first_definition:
         collect_definitions = True
 
-    for i, sentence in sentence_iterator:
-        # Remove any quotes around potential candidate terms
-        clean_sentence = regex.sub(r'([(])[\'"\p{Pi}]|[\'"\p{Pf}]([);:])', r'\1\2', sentence)
-        try:
-            for candidate in best_candidates(clean_sentence):
-                try:
-                    definition = get_definition(candidate, clean_sentence)
-                except (ValueError, IndexError) as e:
-                    log.debug("{} Omitting candidate {}. Reason: {}".format(i, candidate, e.args[0]))
-                    omit += 1
-                else:
-                    try:
-                        definition = select_definition(definition, candidate)
-                    except (ValueError, IndexError) as e:
-                        log.debug("{} Omitting definition {} for candidate {}. Reason: {}".format(i, definition, candidate, e.args[0]))
-                        omit += 1
-                    else:
-                        # Either append the current definition to the list of previous definitions ...
-                        if collect_definitions:
-                            list_abbrev_map[candidate].append(definition)
-                        else:
-                            # Or update the abbreviations map with the current definition
-                            abbrev_map[candidate] = definition
-                        written += 1
-        except (ValueError, IndexError) as e:
-            log.debug("{} Error processing sentence {}: {}".format(i, sentence, e.args[0]))
-    log.debug("{} abbreviations detected and kept ({} omitted)".format(written, omit))
+    if processes is None or processes > 1:
+        results = _map_in_processes(sentence_iterator, processes)
+    else:
+        results = map(_extract_from_sentence, sentence_iterator)
+
+    for sentence_pairs, sentence_omit in results:
+        omit += sentence_omit
+        written += len(sentence_pairs)
+        for candidate, definition in sentence_pairs:
+            # The same pairs recur across sentences, so keep a single copy of each string
+            candidate = sys.intern(candidate)
+            definition = sys.intern(definition)
+            # Either append the current definition to the list of previous definitions ...
+            if collect_definitions:
+                list_abbrev_map[candidate].append(definition)
+            else:
+                # Or update the abbreviations map with the current definition
+                abbrev_map[candidate] = definition
+    log.debug("%s abbreviations detected and kept (%s omitted)", written, omit)
 
     # Return most common definition for each term
     if collect_definitions:
@@ -331,5 +491,20 @@ def extract_abbreviation_definition_pairs(file_path=None,
     return abbrev_map
 
 
+def to_trie(abbrev_map):
+    """
+    Packs an abbreviation map into a compact trie for long-lived lookups.
+    Requires the optional marisa-trie package (pip install abbreviations[trie]).
+
+    :param abbrev_map: dict of abbreviation: definition pairs
+    :return: marisa_trie.BytesTrie mapping each abbreviation to its UTF-8 encoded definition
+    """
+    try:
+        import marisa_trie
+    except ImportError:
+        raise ImportError("to_trie requires marisa-trie: pip install abbreviations[trie]")
+    return marisa_trie.BytesTrie((k, v.encode('utf-8')) for k, v in abbrev_map.items())
+
+
 if __name__ == '__main__':
     print(extract_abbreviation_definition_pairs(file_path=sys.argv[1]))
@@ -12,8 +12,12 @@ setup(
   download_url = 'https://github.com/philgooch/abbreviation-extraction/archive/v0.2.5.tar.gz',
   keywords = ['python3', 'nlp', 'keyword-extraction', 'abbreviations', 'information-extraction'],
   classifiers = [],
+  python_requires='>=3.7',
   install_requires=[
     'regex',
   ],
+  extras_require={
+    'trie': ['marisa-trie'],
+  },
   zip_safe=False,
 )
@@ -24,6 +24,7 @@ Feature: Extraction of abbreviations using Schwartz-Hearst algorithm
     Then "RNase P" should be mapped to "Ribonuclease P"
     Then "SDS-PAGE" should be mapped to "sodium dodecyl sulfate-polyacrylamide gel electrophoresis"
     Then "MALDI" should be mapped to "matrix-assisted laser desorption/ionization"
+    Then the trie should map "WASP" to "Wiskott-Aldrich syndrome protein"
 
 
     Given Text that I want to extract abbreviations from:
@@ -41,8 +42,61 @@ Feature: Extraction of abbreviations using Schwartz-Hearst algorithm
     Then "PoCA 2002" should be mapped to "Proceeds of Crime Act 2002"
 
 
+    Given Text that I want to extract abbreviations from:
+    """
+    The assay buffer () contained bovine serum albumin (BSA).
+    """
+    Then "BSA" should be mapped to "bovine serum albumin"
+
+
+    Given Text that I want to extract abbreviations from using 2 processes:
+    """
+    The endoplasmic reticulum (ER) in Saccharomyces cerevisiae consists of a
+    reticulum underlying the plasma membrane (cortical ER) and ER associated with
+    the nuclear envelope (nuclear ER).
+    Ribonuclease P (RNase P) is a ubiquitous endoribonuclease that cleaves precursor
+    tRNAs to generate mature 5prime prime or minute termini.
+    """
+    Then "ER" should be mapped to "endoplasmic reticulum"
+    Then "RNase P" should be mapped to "Ribonuclease P"
+
+
+    Given Text with lines separated by "\r" that I want to extract abbreviations from:
+    """
+    Values are shown in figure 1 (left
+    The buffer contained bovine serum albumin (BSA).
+    """
+    Then "BSA" should be mapped to "bovine serum albumin"
+
+
+    Given Text with lines separated by "\f" that I want to extract abbreviations from:
+    """
+    Values are shown in figure 1 (left
+    The buffer contained bovine serum albumin (BSA).
+    """
+    Then "BSA" should be mapped to "bovine serum albumin"
+
+
+    Given A cp1252 encoded file that I want to extract abbreviations from:
+    """
+    The bovine serum albumin … shown (BSA) here.
+    """
+    Then "BSA" should be mapped to a definition starting with "bovine serum albumin"
+
+
     Given Text that does not contain a valid abbreviation:
     """
     Bayesian linear regression of actual log(RT)
     """
-    Then "RT" should be null
\ No newline at end of file
+    Then "RT" should be null
+
+
+    Given Text that does not contain a valid abbreviation:
+    """
+    The final step (ABC) used the XY (XY) protocol.
+    """
+    Then "ABC" should be a candidate
+    Then "ABC" should have no definition candidate
+    Then "XY" should have its definition candidate rejected
+    Then "ABC" should be null
+    Then "XY" should be null
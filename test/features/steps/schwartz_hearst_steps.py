@@ -1,3 +1,5 @@
+import os
+import tempfile
 from behave import given, then
 from nose.tools import assert_equals
 import abbreviations.schwartz_hearst as schwartz_hearst
@@ -8,14 +10,77 @@ def step_impl(context):
     context.result = schwartz_hearst.extract_abbreviation_definition_pairs(doc_text=context.text)
 
 
+@given('Text that I want to extract abbreviations from using {processes:d} processes')
+def step_impl(context, processes):
+    context.result = schwartz_hearst.extract_abbreviation_definition_pairs(doc_text=context.text,
+                                                                           processes=processes)
+
+
+@given('Text with lines separated by "{separator}" that I want to extract abbreviations from')
+def step_impl(context, separator):
+    separator = separator.encode('ascii').decode('unicode_escape')
+    context.doc_text = separator.join(context.text.split('\n'))
+    context.result = schwartz_hearst.extract_abbreviation_definition_pairs(doc_text=context.doc_text)
+
+
+@given('A {encoding} encoded file that I want to extract abbreviations from')
+def step_impl(context, encoding):
+    with tempfile.NamedTemporaryFile('wb', suffix='.txt', delete=False) as f:
+        f.write(context.text.encode(encoding))
+    try:
+        context.result = schwartz_hearst.extract_abbreviation_definition_pairs(file_path=f.name)
+    finally:
+        os.remove(f.name)
+
+
 @then(u'"{acronym}" should be mapped to "{term}"')
 def step_impl(context, acronym, term):
     actual_result = context.result
     assert_equals(actual_result.get(acronym), term)
 
 
+@then(u'the trie should map "{acronym}" to "{term}"')
+def step_impl(context, acronym, term):
+    trie = schwartz_hearst.to_trie(context.result)
+    assert_equals(trie[acronym], [term.encode('utf-8')])
+
+
+@then(u'"{acronym}" should be mapped to a definition starting with "{prefix}"')
+def step_impl(context, acronym, prefix):
+    assert context.result.get(acronym, '').startswith(prefix), context.result
+
+
+def find_candidate(sentence, acronym):
+    for candidate in schwartz_hearst.best_candidates(sentence):
+        if candidate.text == acronym:
+            return candidate
+    raise AssertionError('"{}" is not a candidate in: {}'.format(acronym, sentence))
+
+
+@then(u'"{acronym}" should be a candidate')
+def step_impl(context, acronym):
+    candidates = list(schwartz_hearst.best_candidates(context.doc_text))
+    assert acronym in candidates, candidates
+    assert acronym in set(candidates), candidates
+
+
+@then(u'"{acronym}" should have no definition candidate')
+def step_impl(context, acronym):
+    candidate = find_candidate(context.doc_text, acronym)
+    assert_equals(schwartz_hearst.get_definition(candidate, context.doc_text), None)
+
+
+@then(u'"{acronym}" should have its definition candidate rejected')
+def step_impl(context, acronym):
+    candidate = find_candidate(context.doc_text, acronym)
+    definition = schwartz_hearst.get_definition(candidate, context.doc_text)
+    assert definition is not None
+    assert_equals(schwartz_hearst.select_definition(definition, candidate), None)
+
+
 @given('Text that does not contain a valid abbreviation')
 def step_impl(context):
+    context.doc_text = context.text
     context.result = schwartz_hearst.extract_abbreviation_definition_pairs(doc_text=context.text)
 
 